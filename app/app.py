@@ -1,187 +1,346 @@
-import os, base64, mimetypes
-import requests
-import json
-import io
+import os
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
+from typing import IO
+
+import httpx
+import orjson
+import pybase64
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from mangum import Mangum
-from openai import OpenAI
+from pydantic import BaseModel, Field
+from openai import AsyncOpenAI
 
 from dotenv import load_dotenv
 load_dotenv()
 
-openai = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+openai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Request bodies are small JSON documents; anything bigger is rejected unparsed
+MAX_BODY_BYTES = 64_000
+
+
+def _new_http_client() -> httpx.AsyncClient:
+    """Pooled async client for outbound image downloads."""
+    return httpx.AsyncClient(
+        # An explicit transport ignores the client's `limits=`, so size the pool here
+        transport=httpx.AsyncHTTPTransport(
+            retries=2,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+        ),
+        # Images are already compressed, so ask CDNs not to gzip/brotli them again
+        headers={"Accept-Encoding": "identity", "User-Agent": "teewiz-llm"},
+    )
+
+
+# Shared download client. It lives at module scope so warm Lambda invocations
+# reuse its connections (Mangum skips lifespan).
+http_client = _new_http_client()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Reopen the client if an earlier lifespan (e.g. a previous TestClient) closed it
+    global http_client
+    if http_client.is_closed:
+        http_client = _new_http_client()
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class BodyTooLarge(HTTPException):
+    """Raised from ASGI `receive` once a request body passes MAX_BODY_BYTES."""
+
+    def __init__(self):
+        super().__init__(413, "Request body too large")
+
+
+@app.exception_handler(BodyTooLarge)
+async def body_too_large_handler(request, exc: BodyTooLarge) -> JSONResponse:
+    """Answer 413 wherever inside the app the oversized body was read."""
+    return JSONResponse({"detail": exc.detail}, status_code=413)
+
+
+class BodySizeLimitMiddleware:
+    """
+    Plain ASGI middleware rejecting request bodies over `max_bytes` with 413 before
+    they are buffered or parsed. Unlike @app.middleware("http"), it does not relay
+    responses (e.g. the NDJSON stream) through an extra memory stream.
+
+    A declared Content-Length over the cap is refused up front; every body is also
+    counted as it arrives, which catches chunked uploads without a Content-Length.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            if content_length.isdigit() and int(content_length) > self.max_bytes:
+                response = JSONResponse({"detail": "Request body too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+
+            received = 0
+
+            async def receive_limited():
+                nonlocal received
+                message = await receive()
+                if message["type"] == "http.request":
+                    received += len(message.get("body", b""))
+                    if received > self.max_bytes:
+                        # BodyTooLarge subclasses HTTPException because FastAPI's body
+                        # reader re-raises those (anything else becomes a 400); the
+                        # handler above then turns it into a 413 for any reader.
+                        raise BodyTooLarge()
+                return message
 
+            await self.app(scope, receive_limited, send)
+            return
+        await self.app(scope, receive, send)
 
-app = FastAPI()
+
+# Added before CORS so CORS wraps it and 413 responses still carry CORS headers
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=MAX_BODY_BYTES)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["POST", "GET", "OPTIONS"],
     allow_headers=["*"],
+    max_age=86400,  # let browsers cache preflight responses for a day
 )
 
 
-def _inline_image_from_url(url: str) -> dict:
+# The image types the OpenAI image endpoints accept; anything else falls back to PNG
+_MIME2EXT = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/gif": ".gif"}
+_EXT2MIME = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp", ".gif": "image/gif"}
+
+
+def _guess_mime(content_type: str | None, url: str) -> str:
+    """
+    Prefer the response Content-Type if it is a supported image type, then the URL's
+    file extension, then image/png. Generic types such as binary/octet-stream (common
+    on S3 and CDNs) are ignored, since images.edit rejects them.
+    """
+    if content_type:
+        mime = content_type.partition(";")[0].strip().lower()
+        if mime in _MIME2EXT:
+            return mime
+    ext = os.path.splitext(url.split("?")[0])[1].lower()
+    return _EXT2MIME.get(ext, "image/png")
+
+
+async def _inline_image_from_url(client: httpx.AsyncClient, url: str) -> dict:
     """Download URL → data URI block for the Responses API."""
+    # Stream the body into one buffer so it is only copied once before encoding
+    buf = bytearray()
     try:
-        r = requests.get(url, timeout=30)
+        async with client.stream("GET", url, timeout=30.0) as r:
+            status = r.status_code
+            content_type = r.headers.get("Content-Type")
+            if status == 200:
+                async for chunk in r.aiter_bytes():
+                    buf += chunk
     except Exception as e:
         raise HTTPException(502, f"Failed to download {url}: {e}")
-    if r.status_code != 200:
-        raise HTTPException(502, f"GET {url} returned {r.status_code}")
+    if status != 200:
+        raise HTTPException(502, f"GET {url} returned {status}")
 
-    mime = r.headers.get("Content-Type") or mimetypes.guess_type(url)[0] or "image/png"
-    b64 = base64.b64encode(r.content).decode("utf-8")
+    mime = _guess_mime(content_type, url)
+    b64 = pybase64.b64encode(memoryview(buf)).decode("ascii")
     return {
         "type": "input_image",
         "image_url": f"data:{mime};base64,{b64}"
     }
 
-def _download_image_as_fileobj(url: str) -> io.BytesIO:
+async def _download_image_as_fileobj(client: httpx.AsyncClient, url: str) -> tuple[str, IO[bytes], str]:
     """
-    Download the image at `url` into an in-memory BytesIO with a `.name` attribute.
+    Stream the image at `url` into a temp file and return a `(filename, file, mime)`
+    tuple, a file shape the openai SDK accepts directly for multipart uploads.
+    The upload then reads the file in chunks, so the image is never held in memory
+    whole. The caller must close the file.
     Raises HTTPException on failure.
     """
+    file_obj = tempfile.TemporaryFile()
     try:
-        resp = requests.get(url, timeout=30)
-    except Exception as e:
-        raise HTTPException(502, f"Failed to download image from {url}: {e}")
+        try:
+            async with client.stream("GET", url, timeout=30.0) as resp:
+                status = resp.status_code
+                content_type = resp.headers.get("Content-Type")
+                if status == 200:
+                    async for chunk in resp.aiter_bytes():
+                        file_obj.write(chunk)
+        except Exception as e:
+            raise HTTPException(502, f"Failed to download image from {url}: {e}")
 
-    if resp.status_code != 200:
-        raise HTTPException(502, f"GET {url} returned status {resp.status_code}")
+        if status != 200:
+            raise HTTPException(502, f"GET {url} returned status {status}")
+    except BaseException:
+        file_obj.close()
+        raise
+    file_obj.seek(0)
 
     # Guess extension from Content-Type or URL
-    mime = resp.headers.get("Content-Type") or mimetypes.guess_type(url)[0] or "image/png"
-    ext = mimetypes.guess_extension(mime) or ".png"
+    mime = _guess_mime(content_type, url)
+    ext = _MIME2EXT.get(mime, ".png")
     filename = url.split("/")[-1].split("?")[0] or f"input{ext}"
 
-    file_bytes = resp.content
-    file_obj = io.BytesIO(file_bytes)
-    file_obj.name = filename  # openai expects `file.name`
-    return file_obj
+    return filename, file_obj, mime
+
+def _extract_b64(resp) -> list[str]:
+    """Collect the non-empty `b64_json` payloads from an Images API response."""
+    return [b for b in (getattr(i, "b64_json", None) for i in getattr(resp, "data", None) or ()) if b]
+
+def _image_tool(partial_images: int = 0) -> list[dict]:
+    """`tools` payload enabling the Responses API image_generation tool."""
+    return [{"type": "image_generation", "partial_images": partial_images}]
+
+# Responses API stream events that carry image payloads
+_PARTIAL_IMAGE_EVENT = "response.image_generation_call.partial_image"
+_FINAL_IMAGE_EVENT = "response.image_generation_call"
+
+class PromptRequest(BaseModel):
+    """Fields shared by every image endpoint's JSON body."""
+    prompt: str = Field(min_length=1)
+
+
+class GenerateImageRequest(PromptRequest):
+    """JSON body for /images/generate."""
+    n: int = 1
+    size: str = "1024x1024"
+    quality: str | None = None
+    background: str | None = None
+    sampleImageUrls: str | list[str] | None = None
+
+
+class GenerateImageStreamRequest(PromptRequest):
+    """JSON body for /images/generate/stream."""
+    partial_images: int = 0
+
+
+class ImagesResponse(BaseModel):
+    """JSON response of /images/generate; pydantic-core serializes it straight to bytes."""
+    images: list[str]
+
 
 @app.post("/images/generate")
-async def generate_image(request: Request):
+async def generate_image(req: GenerateImageRequest) -> ImagesResponse:
     """
     Non-streaming image generation/edit endpoint.
-    Expects JSON: {
-      prompt: str,
-      n?: int,
-      size?: str,
-      quality?: str,
-      background?: str,
-      sampleImageUrl?: string | [string, ...]
-    }
+    Expects a GenerateImageRequest JSON body; FastAPI answers 422 if it is invalid.
 
-    If `sampleImageUrl` is provided, we download each URL and call openai.images.edit(...) for each image
-    with model="gpt-image-1", passing the file-like object plus the prompt.
+    If `sampleImageUrls` is provided, we download each URL and call openai.images.edit(...) for each image
+    with model="gpt-image-1", passing the downloaded images plus the prompt.
 
     Otherwise, we fall back to openai.images.generate(...) as before.
     Returns JSON {"images": [<base64-string>, ...]}.
     """
-    body = await request.json()
-    prompt = body.get("prompt")
-    if not prompt:
-        raise HTTPException(400, "Missing 'prompt'")
-
-    sample = body.get("sampleImageUrls")
+    sample = req.sampleImageUrls
 
     # ----------- Branch A: sampleImageUrls provided → use images.edit() for all at once  -----------
     if sample:
         # Normalize to a list of URLs
         urls = [sample] if isinstance(sample, str) else sample
-        if not (isinstance(urls, list) and all(isinstance(u, str) for u in urls)):
-            raise HTTPException(400, "`sampleImageUrls` must be a string or list of strings")
 
-        # Download each URL into a BytesIO file-like object
-        file_objs = []
-        for url in urls:
-            file_obj = _download_image_as_fileobj(url)
-            file_objs.append(file_obj)
+        # Download all URLs concurrently into (filename, file, mime) tuples;
+        # the first failure (or cancelling this handler) cancels the remaining downloads
+        tasks = [
+            asyncio.create_task(_download_image_as_fileobj(http_client, u))
+            for u in urls
+        ]
+        try:
+            file_objs = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            # Let cancelled downloads unwind, then close files from those that finished
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, tuple):
+                    result[1].close()
+            raise
 
-        # Call images.edit once with the list of file-like objects
+        # Call images.edit once with the list of file tuples
         try:
-            resp = openai.images.edit(
+            resp = await openai.images.edit(
                 model="gpt-image-1",
-                image=file_objs,
-                prompt=prompt,
-                background=body.get("background"),
-                quality=body.get("quality"),
+                image=list(file_objs),
+                prompt=req.prompt,
+                background=req.background,
+                quality=req.quality,
             )
         except Exception as e:
             raise HTTPException(502, f"OpenAI Images Edit API error: {e}")
+        finally:
+            for _, file_obj, _ in file_objs:
+                file_obj.close()
 
         # Extract base64 outputs from this single edit call
-        all_images = []
-        for item in getattr(resp, "data", []):
-            b64 = getattr(item, "b64_json", None)
-            if b64:
-                all_images.append(b64)
+        all_images = _extract_b64(resp)
 
         if not all_images:
             raise HTTPException(500, "OpenAI Images Edit API returned no images")
 
-        return JSONResponse({"images": all_images})
+        return ImagesResponse(images=all_images)
 
     # ----------- Branch B: no sampleImageUrls → use images.generate() -----------
     try:
-        resp = openai.images.generate(
+        resp = await openai.images.generate(
             model="gpt-image-1",
-            prompt=prompt,
-            n=body.get("n", 1),
-            size=body.get("size", "1024x1024"),
-            quality=body.get("quality"),
-            background=body.get("background"),
+            prompt=req.prompt,
+            n=req.n,
+            size=req.size,
+            quality=req.quality,
+            background=req.background,
             moderation="low"
         )
     except Exception as e:
         raise HTTPException(502, f"OpenAI Images API error: {e}")
 
-    images = []
-    for item in getattr(resp, "data", []):
-        b64 = getattr(item, "b64_json", None)
-        if b64:
-            images.append(b64)
+    images = _extract_b64(resp)
 
     if not images:
         raise HTTPException(500, "OpenAI Images API returned no data")
-    return JSONResponse({"images": images})
+    return ImagesResponse(images=images)
 @app.post("/images/generate/stream")
-async def generate_image_stream(request: Request) -> StreamingResponse:
+async def generate_image_stream(req: GenerateImageStreamRequest) -> StreamingResponse:
     """
     Streaming image generation endpoint (NDJSON over HTTP).
-    Expects JSON: { prompt: str, partial_images?: int }
+    Expects a GenerateImageStreamRequest JSON body; FastAPI answers 422 if it is invalid.
     Streams JSON lines with each chunk as received.
     """
-    body = await request.json()
-    prompt = body.get("prompt")
-    if not prompt:
-        raise HTTPException(status_code=400, detail="Missing 'prompt'")
-
-    stream = openai.responses.create(
+    stream = await openai.responses.create(
         model="gpt-4.1",
-        input=prompt,
-        tools=[{"type": "image_generation", "partial_images": body.get("partial_images", 0)}],
+        input=req.prompt,
+        tools=_image_tool(req.partial_images),
         stream=True
     )
 
-    def generate():
-        for event in stream:
-            if event.type == "response.image_generation_call.partial_image":
-                b64 = event.partial_image_b64
-                print("Yielding")
-                yield json.dumps({ "type": "partial", "b64": b64 }) + "\n"
-            elif event.type == "response.image_generation_call":
-                yield json.dumps({ "type": "final", "b64": event.result }) + "\n"
+    async def generate():
+        dumps = orjson.dumps
+        async for event in stream:
+            event_type = event.type
+            if event_type == _PARTIAL_IMAGE_EVENT:
+                yield dumps({"type": "partial", "b64": event.partial_image_b64}) + b"\n"
+            elif event_type == _FINAL_IMAGE_EVENT:
+                yield dumps({"type": "final", "b64": event.result}) + b"\n"
 
     return StreamingResponse(generate(), media_type="application/x-ndjson")
 
-# Lambda entry point
-handler = Mangum(app)
+# Lambda entry point; lifespan="off" avoids a startup/shutdown cycle per invocation
+handler = Mangum(app, lifespan="off")
 
 if __name__ == "__main__":
+    # loop/http stay on "auto", which picks uvloop and httptools when installed
     uvicorn.run(app, host="0.0.0.0", port=8000)